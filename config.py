@@ -3,10 +3,14 @@ from pathlib import Path
 def get_config():
     return {
         "batch_size": 8,
+        "grad_accum_steps": 4,
         "num_epochs": 20,
         "lr": 10**-4,
         "seq_len": 350,
+        "num_workers": 4,
         "d_model": 512,
+        "loss_chunk_size": 64,
+        "compile": True,
         "datasource": 'opus_books',
         "lang_src": "en",
         "lang_tgt": "it",
@@ -14,7 +18,9 @@ def get_config():
         "model_basename": "tmodel_",
         "preload": "latest",
         "tokenizer_file": "tokenizer_{0}.json",
-        "experiment_name": "runs/tmodel"
+        "token_cache_file": "tokens_{0}_{1}_{2}",
+        "experiment_name": "runs/tmodel",
+        "log_every": 50
     }
 
 def get_weights_file_path(config, epoch: str):
@@ -25,7 +31,7 @@ def get_weights_file_path(config, epoch: str):
 # Find the latest weights file in the weights folder
 def latest_weights_file_path(config):
     model_folder = f"{config['datasource']}_{config['model_folder']}"
-    model_filename = f"{config['model_basename']}*"
+    model_filename = f"{config['model_basename']}*.pt"
     weights_files = list(Path(model_folder).glob(model_filename))
     if len(weights_files) == 0:
         return None
@@ -1,81 +1,124 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+import math
+import numpy as np
+from torch.utils.data import Dataset,Sampler
 
 
 class BilingualDataset(Dataset):
-    def __init__(self,ds,tokeninzer_src,tokenizer_tgt,src_lang,tgt_lang,seq_len):
+    def __init__(self,ds,tokenizer_tgt,src_lang,tgt_lang,seq_len,src_tokens,src_offsets,tgt_tokens,tgt_offsets,return_text=False):
         super().__init__()
         
         self.ds = ds
-        self.tokenizer_src = tokeninzer_src
-        self.tokenizer_tgt = tokenizer_tgt
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.seq_len = seq_len
 
-        self.sos_token = torch.tensor([tokenizer_tgt.token_to_id("[SOS]")],dtype=torch.int64)
-        self.eos_token = torch.tensor([tokenizer_tgt.token_to_id("[EOS]")],dtype=torch.int64)
-        self.pad_token = torch.tensor([tokenizer_tgt.token_to_id("[PAD]")],dtype=torch.int64)
+        # pre-tokenized corpus as flat token buffers + offsets, see get_or_build_token_cache in train.py
+        self.src_tokens = src_tokens
+        self.src_offsets = src_offsets
+        self.tgt_tokens = tgt_tokens
+        self.tgt_offsets = tgt_offsets
+        # reading a row back from ds is the costliest part of a sample, so the raw sentences
+        # are only fetched when asked for (validation); training only needs the cached ids
+        self.return_text = return_text
+
+        # only the special ids are kept, not the tokenizer: samples are built from the cached
+        # ids, so DataLoader workers never tokenize
+        self.sos_id = tokenizer_tgt.token_to_id("[SOS]")
+        self.eos_id = tokenizer_tgt.token_to_id("[EOS]")
+        self.pad_id = tokenizer_tgt.token_to_id("[PAD]")
+
+    def __getstate__(self):
+            # pickle memmaps by file name so spawned workers re-map them instead of copying
+            state = self.__dict__.copy()
+            for key in ("src_tokens","tgt_tokens"):
+                if isinstance(state[key],np.memmap):
+                    state[key] = ("memmap",state[key].filename)
+            return state
+
+    def __setstate__(self,state):
+            for key in ("src_tokens","tgt_tokens"):
+                if isinstance(state[key],tuple) and state[key][0] == "memmap":
+                    state[key] = np.load(state[key][1],mmap_mode='r')
+            self.__dict__.update(state)
 
     def __len__(self):
-            return len(self.ds)
+            return len(self.src_offsets)-1
         
     def __getitem__(self,idx):
-            src_target_pair = self.ds[idx]
-            src_text = src_target_pair['translation'][self.src_lang]
-            tgt_text = src_target_pair['translation'][self.tgt_lang]
+            enc_input_token = self.src_tokens[self.src_offsets[idx]:self.src_offsets[idx+1]]
+            dec_input_token = self.tgt_tokens[self.tgt_offsets[idx]:self.tgt_offsets[idx+1]]
 
-            enc_input_token = self.tokenizer_src.encode(src_text).ids
-            dec_input_token = self.tokenizer_src.encode(tgt_text).ids
+            item = {
+                "encoder_tokens":enc_input_token,
+                "decoder_tokens":dec_input_token,
+            }
+            if self.return_text:
+                src_target_pair = self.ds[idx]
+                item["src_text"] = src_target_pair['translation'][self.src_lang]
+                item["tgt_text"] = src_target_pair['translation'][self.tgt_lang]
+            return item
 
-            enc_num_padding_tokens = self.seq_len - len(enc_input_token)-2
-            dec_num_padding_tokens = self.seq_len - len(dec_input_token)-1
+    def collate(self,batch):
+            # pad to the longest sentence in the batch instead of to seq_len; buffers are
+            # preallocated once per batch and filled straight from the memory-mapped cache,
+            # then handed to torch without another copy
+            enc_width = max(len(item["encoder_tokens"]) for item in batch)+2
+            dec_width = max(len(item["decoder_tokens"]) for item in batch)+1
 
-            if enc_num_padding_tokens < 0 or dec_num_padding_tokens < 0:
-                raise ValueError("Sentence to long")
-            
-            encoder_input = torch.cat(
-                [
-                  self.sos_token,
-                  torch.tensor(enc_input_token,dtype=torch.int64),
-                  self.eos_token,
-                  torch.tensor([self.pad_token]*enc_num_padding_tokens,dtype=torch.int64),
-                ],
-                dim=0,
-            )
-
-            decoder_input = torch.cat(
-                [
-                  self.sos_token,
-                  torch.tensor(dec_input_token,dtype=torch.int64),
-                  torch.tensor([self.pad_token]*dec_num_padding_tokens,dtype=torch.int64),
-                ],
-                dim=0,
-            )
-
-            label = torch.cat(
-                [
-            
-                  torch.tensor(dec_input_token,dtype=torch.int64),
-                  self.eos_token,
-                  torch.tensor([self.pad_token]*dec_num_padding_tokens,dtype=torch.int64),
-                ],
-                dim=0,
-            )
-            assert encoder_input.size(0) == self.seq_len
-            assert decoder_input.size(0) == self.seq_len
-            assert label.size(0) == self.seq_len
-            return {
-                "encoder_input":encoder_input,
-                "decoder_input":decoder_input,
-                "encoder_mask":(encoder_input!=self.pad_token).unsqueeze(0).unsqueeze(0).int(),
-                "decoder_mask":(decoder_input!=self.pad_token).unsqueeze(0).int() & casual_mask(decoder_input.size(0)),
-                "label": label,
-                "src_text":src_text,
-                "tgt_text":tgt_text,
-                
+            encoder_input = np.full((len(batch),enc_width),self.pad_id,dtype=np.int32)
+            decoder_input = np.full((len(batch),dec_width),self.pad_id,dtype=np.int32)
+            label = np.full((len(batch),dec_width),self.pad_id,dtype=np.int32)
+            encoder_input[:,0] = self.sos_id
+            decoder_input[:,0] = self.sos_id
+
+            for i,item in enumerate(batch):
+                enc_tokens = item["encoder_tokens"]
+                dec_tokens = item["decoder_tokens"]
+                enc_len = len(enc_tokens)
+                dec_len = len(dec_tokens)
+
+                encoder_input[i,1:1+enc_len] = enc_tokens
+                encoder_input[i,1+enc_len] = self.eos_id
+                decoder_input[i,1:1+dec_len] = dec_tokens
+                label[i,:dec_len] = dec_tokens
+                label[i,dec_len] = self.eos_id
+
+            collated = {
+                "encoder_input":torch.from_numpy(encoder_input),
+                "decoder_input":torch.from_numpy(decoder_input),
+                "label": torch.from_numpy(label),
             }
+            if self.return_text:
+                collated["src_text"] = [item["src_text"] for item in batch]
+                collated["tgt_text"] = [item["tgt_text"] for item in batch]
+            return collated
+
+
+class LengthBucketSampler(Sampler):
+    # batches of similar-length sentences so per-batch padding stays short; indices are shuffled,
+    # split into mega-batches of batch_size*bucket_factor, sorted by length within each one,
+    # cut into batches, and the batch order is shuffled again
+    def __init__(self,lengths,batch_size,bucket_factor=50,shuffle=True):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.mega_batch_size = batch_size*bucket_factor
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        n = len(self.lengths)
+        indices = torch.randperm(n).tolist() if self.shuffle else list(range(n))
+        batches = []
+        for start in range(0,n,self.mega_batch_size):
+            mega_batch = sorted(indices[start:start+self.mega_batch_size],key=lambda i: self.lengths[i])
+            batches.extend(mega_batch[j:j+self.batch_size] for j in range(0,len(mega_batch),self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return math.ceil(len(self.lengths)/self.batch_size)
 
 def casual_mask(size):
     mask = torch.triu(torch.ones((1,size,size)),diagonal=1).type(torch.int)
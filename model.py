@@ -79,7 +79,7 @@ class MultiHeadAttentionBlock(nn.Module):
         d_k = query.shape[-1]
         attention_scores=(query @ key.transpose(-2,-1))/math.sqrt(d_k)
         if mask is not None:
-            attention_scores.masked_fill_(mask == 0 ,-1e9)
+            attention_scores.masked_fill_(mask == 0 ,torch.finfo(attention_scores.dtype).min)
         attention_scores = attention_scores.softmax(dim = -1)
         if dropout is not None:
             attention_scores = dropout(attention_scores)
@@ -149,7 +149,7 @@ class DecoderBlock(nn.Module):
         x = self.residual_connections[0](x,lambda x:self.self_attention_block(x,x,x,tgt_mask))
         x = self.residual_connections[1](x,lambda x:self.cross_attention_block(x,enocder_output,enocder_output,src_mask))
         x= self.residual_connections[2](x, self.feed_forward_block)
-        return xsource venv/Scripts/activate
+        return x
     
 class Decoder(nn.Module):
     def __init__(self, layers:nn.ModuleList,dropout:float ):
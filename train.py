@@ -1,12 +1,13 @@
-from dataset import BilingualDataset,casual_mask
+from dataset import BilingualDataset,LengthBucketSampler,casual_mask
 from model import build_transformer
 
 from config import get_config,latest_weights_file_path,get_weights_file_path
 
 import torch
 import torch.nn as nn
-from torch.utils.data import random_split,DataLoader,Dataset
+from torch.utils.data import random_split,DataLoader,Dataset,Subset
 from torch.utils.tensorboard import SummaryWriter
+from torch.utils.checkpoint import checkpoint
 
 from datasets import load_dataset
 from tokenizers import Tokenizer
@@ -14,6 +15,13 @@ from tokenizers.models import WordLevel
 from tokenizers.trainers import WordLevelTrainer
 from tokenizers.pre_tokenizers import Whitespace
 
+import hashlib
+import itertools
+import json
+import os
+import threading
+import numpy as np
+
 from tqdm import tqdm
 from pathlib import Path
 
@@ -33,36 +41,154 @@ def get_or_build_tokenizer(config,ds,lang):
         tokenizer = Tokenizer.from_file(str(tokenizer_path))
     return tokenizer
 
+def get_tokenizer_fingerprint(tokenizer):
+    # identifies the vocabulary that produced a token cache
+    return {
+        "vocab_size":tokenizer.get_vocab_size(),
+        "sha256":hashlib.sha256(tokenizer.to_str().encode()).hexdigest(),
+    }
+
+def get_or_build_token_cache(config,ds,tokenizer,lang,chunk_size=10000):
+    # token ids for every sentence stored as one flat int32 array plus offsets,
+    # so sentence i is tokens[offsets[i]:offsets[i+1]]
+    # cached ids belong to specific rows of one dataset, so the name carries the
+    # datasource and language pair, not just the language
+    cache_path = config['token_cache_file'].format(config['datasource'],f'{config["lang_src"]}-{config["lang_tgt"]}',lang)
+    tokens_path = Path(f"{cache_path}.npy")
+    offsets_path = Path(f"{cache_path}_offsets.npy")
+    meta_path = Path(f"{cache_path}_meta.json")
+    tokenizer_fingerprint = get_tokenizer_fingerprint(tokenizer)
+    cached = Path.exists(tokens_path) and Path.exists(offsets_path) and Path.exists(meta_path)
+    # rebuild if the cache was made for other rows of ds or by another (e.g. retrained) tokenizer
+    if cached:
+        meta = json.loads(meta_path.read_text())
+        cached = meta["num_sentences"] == len(ds) and meta.get("tokenizer") == tokenizer_fingerprint
+    if not cached:
+        # one arrow column read instead of materializing the dataset row by row
+        sentences = [pair[lang] for pair in ds['translation']]
+        # ids are cached unpadded and untruncated; padding is done per batch by the dataset
+        tokenizer.no_padding()
+        tokenizer.no_truncation()
+        ids = []
+        # encode_batch runs on the tokenizers thread pool, chunking bounds the memory held by Encoding objects
+        for start in range(0,len(sentences),chunk_size):
+            ids.extend(encoding.ids for encoding in tokenizer.encode_batch(sentences[start:start+chunk_size]))
+        offsets = np.zeros(len(ids)+1,dtype=np.int64)
+        np.cumsum([len(x) for x in ids],out=offsets[1:])
+        tokens = np.fromiter(itertools.chain.from_iterable(ids),dtype=np.int32,count=int(offsets[-1]))
+        np.save(tokens_path,tokens)
+        np.save(offsets_path,offsets)
+        # length summary written alongside, so startup never has to rescan the corpus
+        lengths = np.diff(offsets)
+        meta = {
+            "num_sentences":len(ids),
+            "tokenizer":tokenizer_fingerprint,
+            "max_len":int(lengths.max()),
+            "length_histogram":np.bincount(lengths).tolist(),
+        }
+        meta_path.write_text(json.dumps(meta))
+    # memory-mapped read-only so DataLoader workers share the page cache
+    tokens = np.load(tokens_path,mmap_mode='r')
+    offsets = np.load(offsets_path)
+    meta = json.loads(meta_path.read_text())
+    return tokens,offsets,meta
+
+def get_worker_kwargs(num_workers):
+    # build samples in background workers so the next batches are ready while the GPU is busy
+    if num_workers == 0:
+        return {}
+    return {"num_workers":num_workers,"prefetch_factor":4,"persistent_workers":True}
+
 def get_ds(config):
     ds_raw =  load_dataset('opus_books',f'{config["lang_src"]}-{config["lang_tgt"]}',split='train')
     tokenizer_src = get_or_build_tokenizer(config,ds_raw,config["lang_src"]) 
     tokenizer_tgt = get_or_build_tokenizer(config,ds_raw,config["lang_tgt"]) 
 
-    train_ds_size = int(0.9 * len(ds_raw))
-    val_ds_size = len(ds_raw)-train_ds_size
-    train_ds_raw,val_ds_raw = random_split(ds_raw,[train_ds_size,val_ds_size])  
-
-    train_ds = BilingualDataset(train_ds_raw,tokenizer_src,tokenizer_tgt,config["lang_src"],config["lang_tgt"],config["seq_len"]) 
-    val_ds = BilingualDataset(val_ds_raw,tokenizer_src,tokenizer_tgt,config["lang_src"],config["lang_tgt"],config["seq_len"]) 
+    src_tokens,src_offsets,src_meta = get_or_build_token_cache(config,ds_raw,tokenizer_src,config["lang_src"])
+    tgt_tokens,tgt_offsets,tgt_meta = get_or_build_token_cache(config,ds_raw,tokenizer_tgt,config["lang_tgt"])
 
-    max_len_src = 0
-    max_len_tgt = 0
+    # encoding is done; quiets the tokenizers at-fork warning in workers unless the user set it
+    os.environ.setdefault("TOKENIZERS_PARALLELISM","false")
 
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
+    max_len_src = src_meta["max_len"]
+    max_len_tgt = tgt_meta["max_len"]
 
     print(f'Max length of source sentence: {max_len_src}')
     print(f'Max length of target sentence: {max_len_tgt}')
 
-    train_dataloader = DataLoader(train_ds,batch_size=config["batch_size"],shuffle=True)
-    val_dataloader = DataLoader(val_ds,batch_size=1,shuffle=True)
+    # encoder input adds [SOS]+[EOS], decoder input/label add one of them
+    min_seq_len = max(max_len_src+2,max_len_tgt+1)
+    # seq_len None sizes the model to the corpus instead of a fixed value
+    if config["seq_len"] is None:
+        config["seq_len"] = min_seq_len
+        print(f'Using seq_len: {min_seq_len}')
+    elif min_seq_len > config["seq_len"]:
+        raise ValueError(f'seq_len {config["seq_len"]} is too short, need at least {min_seq_len}')
+
+    ds = BilingualDataset(ds_raw,tokenizer_tgt,config["lang_src"],config["lang_tgt"],config["seq_len"],src_tokens,src_offsets,tgt_tokens,tgt_offsets)
+
+    train_ds_size = int(0.9 * len(ds))
+    val_ds_size = len(ds)-train_ds_size
+    train_ds,val_ds = random_split(ds,[train_ds_size,val_ds_size])
+    # same split, but validation batches also carry the raw sentences
+    val_text_ds = BilingualDataset(ds_raw,tokenizer_tgt,config["lang_src"],config["lang_tgt"],config["seq_len"],src_tokens,src_offsets,tgt_tokens,tgt_offsets,return_text=True)
+    val_ds = Subset(val_text_ds,val_ds.indices)
+
+    # page-locked batches let the .to(device, non_blocking=True) copies run as async DMA
+    pin_memory = torch.cuda.is_available()
+    num_workers = config["num_workers"]
+    train_sampler = LengthBucketSampler(np.diff(src_offsets)[train_ds.indices],config["batch_size"])
+    train_dataloader = DataLoader(train_ds,batch_sampler=train_sampler,collate_fn=ds.collate,pin_memory=pin_memory,**get_worker_kwargs(num_workers))
+    val_dataloader = DataLoader(val_ds,batch_size=1,shuffle=True,collate_fn=val_text_ds.collate,pin_memory=pin_memory,**get_worker_kwargs(min(2,num_workers)))
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
 
+def chunked_projection_loss(project,loss_fn,dec_out,labels,pad_id,chunk_size):
+    # project + cross-entropy chunk_size time steps at a time; checkpoint drops each chunk's
+    # (B,chunk_size,V) logits after forward and recomputes them in backward, so the full
+    # (B*T,V) logits tensor is never materialized. loss_fn must use reduction='sum'.
+    def chunk_loss(x,y):
+        logits = project(x).float()
+        return loss_fn(logits.view(-1,logits.size(-1)),y.reshape(-1))
+
+    loss = 0
+    for start in range(0,dec_out.size(1),chunk_size):
+        loss = loss + checkpoint(chunk_loss,dec_out[:,start:start+chunk_size],labels[:,start:start+chunk_size],use_reentrant=False)
+    # same normalization as reduction='mean' with ignore_index
+    return loss / (labels != pad_id).sum().clamp(min=1)
+
+def to_cpu(obj):
+    # CPU copies of every tensor in a (nested) state dict
+    if isinstance(obj,torch.Tensor):
+        return obj.detach().to('cpu',copy=True)
+    if isinstance(obj,dict):
+        return {k:to_cpu(v) for k,v in obj.items()}
+    if isinstance(obj,(list,tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+class CheckpointWriter(threading.Thread):
+    # atomic (.tmp + rename) torch.save on a thread; errors are re-raised from join()
+    def __init__(self,ckpt,ckpt_file):
+        super().__init__()
+        self.ckpt = ckpt
+        self.ckpt_file = Path(ckpt_file)
+        self.error = None
+
+    def run(self):
+        tmp_file = self.ckpt_file.with_suffix('.tmp')
+        try:
+            torch.save(self.ckpt,tmp_file)
+            os.replace(tmp_file,self.ckpt_file)
+        except BaseException as e:
+            self.error = e
+
+    def join(self,timeout=None):
+        super().join(timeout)
+        if self.error is not None:
+            raise self.error
+
 def get_model(config,vocab_src_len,vocab_tgt_len):
     model =  build_transformer(vocab_src_len,vocab_tgt_len,config['seq_len'],config['seq_len'],d_model=config["d_model"])
     return model
@@ -86,9 +212,17 @@ def train_model(config):
         tokenizer_tgt.get_vocab_size()
     ).to(device)
 
+    # compile the encode/decode/project methods (Transformer has no forward())
+    if config['compile'] and device.type == 'cuda':
+        model.encode  = torch.compile(model.encode, mode='max-autotune-no-cudagraphs', dynamic=True)
+        model.decode  = torch.compile(model.decode, mode='max-autotune-no-cudagraphs', dynamic=True)
+        model.project = torch.compile(model.project, mode='max-autotune-no-cudagraphs', dynamic=True)
+
     # 5) tensorboard + optimizer
     writer    = SummaryWriter(config["experiment_name"])
-    optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-9)
+    # fused=True updates every parameter in a single CUDA kernel instead of per-tensor launches
+    fused     = device.type == 'cuda'
+    optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-9, fused=fused)
 
     # 6) default to starting from epoch 0
     initial_epoch = 0
@@ -109,54 +243,103 @@ def train_model(config):
             global_step   = state.get('global_step', 0)
             model.load_state_dict(state['model_state_dict'])
             optimizer.load_state_dict(state['optimizer_state_dict'])
+            # param_groups come from the checkpoint, which may predate fused; load_state_dict
+            # then left 'step' on the CPU, while the fused kernel expects it on the param device
+            for group in optimizer.param_groups:
+                group['fused'] = fused
+                if fused:
+                    for p in group['params']:
+                        p_state = optimizer.state.get(p, {})
+                        if 'step' in p_state:
+                            p_state['step'] = torch.as_tensor(p_state['step'], dtype=torch.float32, device=p.device)
         else:
             print("No checkpoint found; starting from scratch.")
 
     # 8) loss function
+    pad_id  = tokenizer_tgt.token_to_id('[PAD]')
     loss_fn = torch.nn.CrossEntropyLoss(
-        ignore_index=tokenizer_tgt.token_to_id('[PAD]'),
-        label_smoothing=0.1
+        ignore_index=pad_id,
+        label_smoothing=0.1,
+        reduction='sum'
     ).to(device)
 
+    # masks are a function of the token ids, so they are built on the device per batch
+    # instead of being built per sample on the CPU and copied over; (1,1,seq_len,seq_len),
+    # sliced to each batch's padded length
+    causal_m = casual_mask(config['seq_len']).unsqueeze(0).to(device)
+
+    # mixed precision on CUDA: bf16 where supported, otherwise fp16 with loss scaling
+    # (bf16 has the fp32 exponent range, so it needs no scaler)
+    use_amp   = device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    scaler    = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
+
+    accum_steps = config['grad_accum_steps']
+    num_batches = len(train_dataloader)
+    last_group_start = num_batches - num_batches % accum_steps
+    log_every   = config['log_every']
+
+    save_thread = None
+
     # 9) training loop
     for epoch in range(initial_epoch, config['num_epochs']):
         model.train()
         loop = tqdm(train_dataloader, desc=f"Epoch {epoch:02d}")
-        for batch in loop:
-            enc_in = batch['encoder_input'].to(device)
-            dec_in = batch['decoder_input'].to(device)
-            enc_m  = batch['encoder_mask'].to(device)
-            dec_m  = batch['decoder_mask'].to(device)
-            labels = batch['label'].to(device)
-
-            enc_out = model.encode(enc_in, enc_m)
-            dec_out = model.decode(enc_out, enc_m, dec_in, dec_m)
-            logits  = model.project(dec_out)
-
-            loss = loss_fn(
-                logits.view(-1, tokenizer_tgt.get_vocab_size()),
-                labels.view(-1)
-            )
-
-            loop.set_postfix(loss=loss.item())
-            writer.add_scalar('train_loss', loss.item(), global_step)
-            writer.flush()
-
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
+        loss_accum = torch.zeros((), device=device)
+        for i, batch in enumerate(loop):
+            enc_in = batch['encoder_input'].to(device, non_blocking=True)
+            dec_in = batch['decoder_input'].to(device, non_blocking=True)
+            # token ids cross the link as int32, the loss wants int64 targets
+            labels = batch['label'].to(device, non_blocking=True).long()
+            enc_m  = (enc_in != pad_id)[:, None, None, :]
+            dec_len = dec_in.size(1)
+            dec_m  = (dec_in != pad_id)[:, None, None, :] & causal_m[:, :, :dec_len, :dec_len]
+
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                enc_out = model.encode(enc_in, enc_m)
+                dec_out = model.decode(enc_out, enc_m, dec_in, dec_m)
+                loss    = chunked_projection_loss(
+                    model.project, loss_fn, dec_out, labels, pad_id, config['loss_chunk_size']
+                )
+
+            # .item() syncs with the GPU, so losses are summed on the device and only read
+            # back as a log_every-microbatch average
+            loss_accum += loss.detach()
+            if (i + 1) % log_every == 0:
+                train_loss = (loss_accum / log_every).item()
+                loss_accum.zero_()
+                loop.set_postfix(loss=train_loss)
+                writer.add_scalar('train_loss', train_loss, global_step)
+
+            # accumulate grad_accum_steps microbatches per optimizer step; a trailing partial
+            # group of the epoch is averaged over its own size and stepped too
+            group_size = accum_steps if i < last_group_start else num_batches - last_group_start
+            scaler.scale(loss / group_size).backward()
+            if (i + 1) % accum_steps == 0 or i + 1 == num_batches:
+                scaler.step(optimizer)
+                scaler.update()
+                # drop the .grad tensors instead of zero-filling them; backward allocates them fresh
+                optimizer.zero_grad(set_to_none=True)
 
             global_step += 1
 
-        # 10) save checkpoint at end of each epoch
+        writer.flush()
+
+        # 10) save checkpoint at end of each epoch, in the background
         ckpt_file = model_dir / f"{config['model_basename']}{epoch:02d}.pt"
-        torch.save({
+        if save_thread is not None:
+            save_thread.join()
+        ckpt = to_cpu({
             'epoch':                   epoch,
             'global_step':             global_step,
             'model_state_dict':        model.state_dict(),
             'optimizer_state_dict':    optimizer.state_dict()
-        }, ckpt_file)
+        })
+        save_thread = CheckpointWriter(ckpt, ckpt_file)
+        save_thread.start()
 
+    if save_thread is not None:
+        save_thread.join()
     writer.close()
 
 